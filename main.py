@@ -19,16 +19,20 @@ and Datastore.
 """
 
 import collections
+import hashlib
 import json
 import logging
 import os
-import urllib
+import threading
 
 import cloudstorage
 import jinja2
 import webapp2
 from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 import googleapiclient.discovery
 
@@ -38,11 +42,33 @@ THUMBNAIL_BUCKET = 'thumbnails-bucket'
 PHOTO_BUCKET = 'shared-photo-album'
 NUM_NOTIFICATIONS_TO_DISPLAY = 50
 MAX_LABELS = 5
+PROCESSING_QUEUE = 'photo-processing'
+GCS_WRITE_RETRY_PARAMS = cloudstorage.RetryParams(
+    backoff_factor=1.1,
+    max_retry_period=15)
+SERVING_URL_CACHE_PREFIX = 'serving_url:'
+PHOTOS_VERSION_KEY = 'photos:version'
+PHOTOS_CACHE_PREFIX = 'photos:page:'
+PHOTOS_CACHE_SECONDS = 10 * 60
+PHOTOS_RECHECK_SECONDS = 15
+# Words that are not added as labels on their own.
+IGNORED_LABEL_WORDS = frozenset(
+    ['of', 'like', 'the', 'and', 'a', 'an', 'with'])
 
 # Set up jinja2 for HTML templating.
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 jinja_environment = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(template_dir))
+    loader=jinja2.FileSystemLoader(template_dir),
+    auto_reload=False)
+
+# Templates are compiled once at startup rather than looked up per request.
+notifications_template = jinja_environment.get_template('notifications.html')
+photos_template = jinja_environment.get_template('photos.html')
+search_template = jinja_environment.get_template('search.html')
+
+# Vision API clients, built once per thread. The app is threadsafe and
+# the underlying httplib2 connection must not be shared between threads.
+_vision = threading.local()
 
 
 class Notification(ndb.Model):
@@ -65,7 +91,7 @@ class ThumbnailReference(ndb.Model):
 
     thumbnail_name: same as photo name.
     thumbnail_key: used to distinguish similarly named photos. Includes
-    photo name and generation number.
+    photo name and generation number. Also used as the entity id.
     labels: list of label_names that apply to the photo.
     original_photo: url of the original photo, stored in GCS."""
 
@@ -76,6 +102,14 @@ class ThumbnailReference(ndb.Model):
     original_photo = ndb.StringProperty()
 
 
+class DeletedThumbnail(ndb.Model):
+    """Marks a thumbnail whose photo was deleted or archived before its
+    ThumbnailReference was stored, so the create task does not store one.
+
+    Its parent is the key the ThumbnailReference would have, so both are
+    read and written in the same entity group."""
+
+
 class MainHandler(webapp2.RequestHandler):
     """Home/news feed page (notification listing)."""
     def get(self):
@@ -83,25 +117,35 @@ class MainHandler(webapp2.RequestHandler):
         notifications = Notification.query().order(
             -Notification.date).fetch(NUM_NOTIFICATIONS_TO_DISPLAY)
         template_values = {'notifications': notifications}
-        template = jinja_environment.get_template('notifications.html')
-        self.response.write(template.render(template_values))
+        self.response.write(notifications_template.render(template_values))
 
 
 class PhotosHandler(webapp2.RequestHandler):
     """All photos page: displays thumbnails of all uploaded photos."""
     def get(self):
-        # Get thumbnail references from datastore in reverse date order.
-        thumbnail_references = ThumbnailReference.query().order(
-            -ThumbnailReference.date).fetch()
-        # Build dictionary of img_url of thumbnail to thumbnail_references.
-        thumbnails = collections.OrderedDict()
-        for thumbnail_reference in thumbnail_references:
-            img_url = get_thumbnail_serving_url(
-                thumbnail_reference.thumbnail_key)
-            thumbnails[img_url] = thumbnail_reference
+        # The page's thumbnails are cached under the current gallery version,
+        # which is bumped whenever a thumbnail is added or removed.
+        version = memcache.get(PHOTOS_VERSION_KEY) or 0
+        cache_key = '{}{}'.format(PHOTOS_CACHE_PREFIX, version)
+        thumbnails = memcache.get(cache_key)
+        if thumbnails is None:
+            # Get thumbnail references from datastore in reverse date order.
+            thumbnail_references = ThumbnailReference.query().order(
+                -ThumbnailReference.date).fetch()
+            # Build dictionary of img_url of thumbnail to
+            # thumbnail_references.
+            img_urls = get_thumbnail_serving_urls(
+                [reference.thumbnail_key
+                 for reference in thumbnail_references])
+            thumbnails = collections.OrderedDict(
+                zip(img_urls, thumbnail_references))
+            try:
+                memcache.set(
+                    cache_key, thumbnails, time=PHOTOS_CACHE_SECONDS)
+            except ValueError:
+                logging.warning('Photos page too large to cache.')
         template_values = {'thumbnails': thumbnails}
-        template = jinja_environment.get_template('photos.html')
-        self.response.write(template.render(template_values))
+        self.response.write(photos_template.render(template_values))
 
     """Uploads or deletes photos from GCS photo bucket."""
     def post(self):
@@ -115,7 +159,8 @@ class PhotosHandler(webapp2.RequestHandler):
         to_delete = self.request.get('img-delete')
         if to_delete:
             exists_delete = ThumbnailReference.query(
-                ThumbnailReference.thumbnail_name == to_delete).get()
+                ThumbnailReference.thumbnail_name == to_delete).get(
+                keys_only=True)
             if exists_delete:
                 delete_photo_from_gcs(to_delete)
         self.redirect('/photos')
@@ -127,19 +172,17 @@ class SearchHandler(webapp2.RequestHandler):
     def get(self):
         # Get search_term entered by user.
         search_term = self.request.get('search-term').lower()
-        references = ThumbnailReference.query().order(
+        # Let Datastore return only the references that have the given
+        # label, in reverse date order.
+        references = ThumbnailReference.query(
+            ThumbnailReference.labels == search_term).order(
             -ThumbnailReference.date).fetch()
-        # Build dictionary of img_url of thumbnails to
-        # thumbnail_references that have the given label.
-        thumbnails = collections.OrderedDict()
-        for reference in references:
-            labels = reference.labels
-            if search_term in labels:
-                img_url = get_thumbnail_serving_url(reference.thumbnail_key)
-                thumbnails[img_url] = reference
+        # Build dictionary of img_url of thumbnails to thumbnail_references.
+        img_urls = get_thumbnail_serving_urls(
+            [reference.thumbnail_key for reference in references])
+        thumbnails = collections.OrderedDict(zip(img_urls, references))
         template_values = {'thumbnails': thumbnails}
-        template = jinja_environment.get_template('search.html')
-        self.response.write(template.render(template_values))
+        self.response.write(search_template.render(template_values))
 
 
 class ReceiveMessage(webapp2.RequestHandler):
@@ -147,7 +190,7 @@ class ReceiveMessage(webapp2.RequestHandler):
     related logic."""
     def post(self):
         logging.debug('Post body: {}'.format(self.request.body))
-        message = json.loads(urllib.unquote(self.request.body))
+        message = json.loads(self.request.body)
         attributes = message['message']['attributes']
 
         # Acknowledge message.
@@ -163,12 +206,11 @@ class ReceiveMessage(webapp2.RequestHandler):
 
         # Create the thumbnail_key using the photo_name and generation_number.
         # Note: Only photos with extension .jpg can be uploaded effectively.
-        try:
-          index = photo_name.index('.jpg')
-        except:
-          return
+        photo_base, photo_ext = os.path.splitext(photo_name or '')
+        if photo_ext.lower() != '.jpg':
+            return
         thumbnail_key = '{}{}{}'.format(
-            photo_name[:index], generation_number, photo_name[index:])
+            photo_base, generation_number, photo_ext)
 
         # Create the Notification using the received information.
         new_notification = create_notification(
@@ -178,42 +220,96 @@ class ReceiveMessage(webapp2.RequestHandler):
             overwrote_generation=overwrote_generation,
             overwritten_by_generation=overwritten_by_generation)
 
-        # If the new_notification already has been stored, it is a
-        # repeat and can be ignored.
-        exists_notification = Notification.query(
-            Notification.message == new_notification.message,
-            Notification.generation == new_notification.generation).get()
-
-        if exists_notification:
-            return
-
         # Don't act for metadata update events.
         if new_notification.message is None:
             return
 
-        # Store new_notification in datastore.
-        new_notification.put()
+        # If the new_notification already has been stored, it is a
+        # repeat and can be ignored.
+        if new_notification.key.get():
+            return
 
-        # For create events: shrink the photo to thumbnail size,
-        # store the thumbnail in GCS, and create a ThumbnailReference
-        # and store it in Datastore.
+        # The notification for a create event is stored by process_event
+        # in the same batch as the ThumbnailReference.
         if event_type == 'OBJECT_FINALIZE':
-            thumbnail = create_thumbnail(photo_name)
-            store_in_gcs(thumbnail_key, thumbnail, THUMBNAIL_BUCKET)
-            original_photo = get_original_url(photo_name, generation_number)
-            uri = 'gs://{}/{}'.format(PHOTO_BUCKET, photo_name)
-            labels = get_labels(uri, photo_name)
-            thumbnail_reference = ThumbnailReference(
-                thumbnail_name=photo_name,
-                thumbnail_key=thumbnail_key,
-                labels=list(labels),
-                original_photo=original_photo)
-            thumbnail_reference.put()
-
-        # For delete/archive events: delete the thumbnail from GCS
-        # and delete the ThumbnailReference.
-        elif event_type == 'OBJECT_DELETE' or event_type == 'OBJECT_ARCHIVE':
-            delete_thumbnail(thumbnail_key)
+            pending_notification = new_notification
+        else:
+            pending_notification = None
+
+        # Hand the thumbnail and label work off to a task so the message is
+        # acknowledged right away. The task is named after the notification
+        # so a concurrent repeat of this message is not processed twice.
+        try:
+            deferred.defer(
+                process_event,
+                event_type,
+                photo_name,
+                generation_number,
+                thumbnail_key,
+                notification=pending_notification,
+                _name=new_notification.key.id(),
+                _queue=PROCESSING_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+        # Store the notifications of other events in datastore here.
+        if pending_notification is None:
+            new_notification.put()
+
+
+# Performs the work for a Pub/Sub event. Runs as a deferred task on the
+# PROCESSING_QUEUE. If given, notification is stored along with the
+# ThumbnailReference of a create event.
+def process_event(event_type,
+                  photo_name,
+                  generation_number,
+                  thumbnail_key,
+                  notification=None):
+    # For create events: shrink the photo to thumbnail size,
+    # store the thumbnail in GCS, and create a ThumbnailReference
+    # and store it in Datastore.
+    if event_type == 'OBJECT_FINALIZE':
+        # The resize runs while the Vision API labels the original photo.
+        thumbnail_rpc = create_thumbnail_async(photo_name)
+        uri = 'gs://{}/{}'.format(PHOTO_BUCKET, photo_name)
+        labels = get_labels(uri, os.path.splitext(photo_name)[0])
+        try:
+            thumbnail = thumbnail_rpc.get_result()
+        except images.Error:
+            # If the photo was deleted before its thumbnail was made, a retry
+            # cannot succeed. Still show the upload notification.
+            try:
+                cloudstorage.stat('/{}/{}'.format(PHOTO_BUCKET, photo_name))
+            except cloudstorage.NotFoundError:
+                if notification is not None:
+                    notification.put()
+                raise deferred.PermanentTaskFailure(
+                    '{} no longer exists.'.format(photo_name))
+            raise
+        store_in_gcs(thumbnail_key, thumbnail, THUMBNAIL_BUCKET)
+        original_photo = get_original_url(photo_name, generation_number)
+        thumbnail_reference = ThumbnailReference(
+            id=thumbnail_key,
+            thumbnail_name=photo_name,
+            thumbnail_key=thumbnail_key,
+            labels=list(labels),
+            original_photo=original_photo)
+        if not store_thumbnail_reference(thumbnail_reference, notification):
+            # The photo was deleted while its thumbnail was being made, so
+            # the thumbnail is no longer needed.
+            try:
+                cloudstorage.delete(
+                    '/{}/{}'.format(THUMBNAIL_BUCKET, thumbnail_key))
+            except cloudstorage.NotFoundError:
+                pass
+            return
+        invalidate_photos_cache()
+
+    # For delete/archive events: delete the thumbnail from GCS
+    # and delete the ThumbnailReference.
+    elif event_type == 'OBJECT_DELETE' or event_type == 'OBJECT_ARCHIVE':
+        delete_thumbnail(thumbnail_key)
 
 
 # Create a Notification to be stored in Datastore.
@@ -241,17 +337,36 @@ def create_notification(photo_name,
         else:
             message = '{} was deleted.'.format(photo_name)
     else:
-        message = None
-
-    return Notification(message=message, generation=generation)
-
-
-# Returns serving url for a given thumbnail, specified
-# by the photo_name parameter.
-def get_thumbnail_serving_url(photo_name):
-    filename = '/gs/{}/{}'.format(THUMBNAIL_BUCKET, photo_name)
-    blob_key = blobstore.create_gs_key(filename)
-    return images.get_serving_url(blob_key)
+        return Notification(message=None, generation=generation)
+
+    # The message and generation identify a notification, so use them as its
+    # id. Repeats can then be detected with a get rather than a query.
+    notification_id = '{}-{}'.format(
+        generation, hashlib.md5(message.encode('utf-8')).hexdigest())
+    return Notification(
+        id=notification_id, message=message, generation=generation)
+
+
+# Returns serving urls for a list of thumbnails, in the same order. Urls
+# are looked up in memcache first; the serving url RPCs for any misses
+# are all started before waiting on any of them.
+def get_thumbnail_serving_urls(thumbnail_keys):
+    cached = memcache.get_multi(
+        thumbnail_keys, key_prefix=SERVING_URL_CACHE_PREFIX)
+    rpcs = {}
+    for thumbnail_key in thumbnail_keys:
+        if thumbnail_key in cached or thumbnail_key in rpcs:
+            continue
+        filename = '/gs/{}/{}'.format(THUMBNAIL_BUCKET, thumbnail_key)
+        blob_key = blobstore.create_gs_key(filename)
+        rpcs[thumbnail_key] = images.get_serving_url_async(blob_key)
+    fetched = dict(
+        (thumbnail_key, rpc.get_result())
+        for thumbnail_key, rpc in rpcs.iteritems())
+    if fetched:
+        memcache.set_multi(fetched, key_prefix=SERVING_URL_CACHE_PREFIX)
+    cached.update(fetched)
+    return [cached[thumbnail_key] for thumbnail_key in thumbnail_keys]
 
 
 # Returns the url of the original photo.
@@ -264,38 +379,110 @@ def get_original_url(photo_name, generation):
     return original_photo
 
 
-# Shrinks specified photo to thumbnail size and returns resulting thumbnail.
-def create_thumbnail(photo_name):
+# Starts shrinking specified photo to thumbnail size. Returns an RPC whose
+# result is the resulting thumbnail.
+def create_thumbnail_async(photo_name):
     filename = '/gs/{}/{}'.format(PHOTO_BUCKET, photo_name)
     image = images.Image(filename=filename)
     image.resize(width=180, height=200)
-    return image.execute_transforms(output_encoding=images.JPEG)
+    return image.execute_transforms_async(output_encoding=images.JPEG)
 
 
-# Stores thumbnail in GCS bucket under name thumbnail_key.
+# Stores image in GCS bucket under name image_name.
 def store_in_gcs(image_name, image, bucket):
-    write_retry_params = cloudstorage.RetryParams(
-        backoff_factor=1.1,
-        max_retry_period=15)
     filename = '/{}/{}'.format(bucket, image_name)
     with cloudstorage.open(
               filename, 'w', content_type='image/jpeg',
-              retry_params=write_retry_params) as filehandle:
+              retry_params=GCS_WRITE_RETRY_PARAMS) as filehandle:
         filehandle.write(image)
 
 
+# Bumps the gallery version so the cached photos page is rebuilt.
+def bump_photos_version():
+    memcache.incr(PHOTOS_VERSION_KEY, initial_value=0)
+
+
+# Invalidates the cached photos page after a thumbnail is added or removed.
+# The gallery query is eventually consistent, so a page rebuilt right after
+# the write may not reflect it yet. The version is bumped again after
+# PHOTOS_RECHECK_SECONDS so that such a page is only served briefly.
+def invalidate_photos_cache():
+    bump_photos_version()
+    deferred.defer(
+        bump_photos_version,
+        _countdown=PHOTOS_RECHECK_SECONDS,
+        _queue=PROCESSING_QUEUE)
+
+
+# Returns the key of the DeletedThumbnail marker for thumbnail_key.
+def deleted_thumbnail_key(thumbnail_key):
+    return ndb.Key(
+        ThumbnailReference, thumbnail_key, DeletedThumbnail, thumbnail_key)
+
+
+# Stores thumbnail_reference, along with notification if given, unless its
+# photo has already been deleted. Returns whether the reference was stored.
+@ndb.transactional(xg=True)
+def store_thumbnail_reference(thumbnail_reference, notification):
+    if deleted_thumbnail_key(thumbnail_reference.key.id()).get():
+        if notification is not None:
+            notification.put()
+        return False
+    if notification is not None:
+        ndb.put_multi([notification, thumbnail_reference])
+    else:
+        thumbnail_reference.put()
+    return True
+
+
+# Deletes the ThumbnailReference keyed by thumbnail_key. If it has not been
+# stored yet, marks the thumbnail as deleted so that a create task still
+# in progress does not store it. Returns whether a reference was deleted.
+@ndb.transactional_tasklet
+def delete_thumbnail_reference_async(thumbnail_key):
+    reference_key = ndb.Key(ThumbnailReference, thumbnail_key)
+    thumbnail_reference = yield reference_key.get_async()
+    if thumbnail_reference:
+        yield reference_key.delete_async()
+    else:
+        yield DeletedThumbnail(
+            key=deleted_thumbnail_key(thumbnail_key)).put_async()
+    raise ndb.Return(thumbnail_reference is not None)
+
+
 # Deletes thumbnail from GCS bucket and deletes thumbnail_reference from
 # datastore.
 def delete_thumbnail(thumbnail_key):
     filename = '/gs/{}/{}'.format(THUMBNAIL_BUCKET, thumbnail_key)
     blob_key = blobstore.create_gs_key(filename)
-    images.delete_serving_url(blob_key)
-    thumbnail_reference = ThumbnailReference.query(
-        ThumbnailReference.thumbnail_key == thumbnail_key).get()
-    thumbnail_reference.key.delete()
-
+    # The deletes are independent, so start the serving url and datastore
+    # deletes and wait on them after the (synchronous) GCS delete.
+    serving_url_rpc = images.delete_serving_url_async(blob_key)
+    memcache.delete(SERVING_URL_CACHE_PREFIX + thumbnail_key)
+    reference_future = delete_thumbnail_reference_async(thumbnail_key)
+
+    # The thumbnail may already be gone, e.g. on a retry or when its photo
+    # was deleted before a thumbnail was made.
     filename = '/{}/{}'.format(THUMBNAIL_BUCKET, thumbnail_key)
-    cloudstorage.delete(filename)
+    try:
+        cloudstorage.delete(filename)
+    except cloudstorage.NotFoundError:
+        pass
+    finally:
+        # Always wait on the started deletes and rebuild the photos page,
+        # even if the GCS delete failed.
+        try:
+            serving_url_rpc.get_result()
+            if not reference_future.get_result():
+                # References stored before they were keyed by
+                # thumbnail_key are found with a query.
+                legacy_key = ThumbnailReference.query(
+                    ThumbnailReference.thumbnail_key == thumbnail_key).get(
+                    keys_only=True)
+                if legacy_key:
+                    legacy_key.delete()
+        finally:
+            invalidate_photos_cache()
 
 
 # Deletes photo from GCS bucket.
@@ -304,15 +491,22 @@ def delete_photo_from_gcs(photo_name):
     cloudstorage.delete(filename)
 
 
-# Use Cloud Vision API to get labels for a photo.
-def get_labels(uri, photo_name):
-    service = googleapiclient.discovery.build('vision', 'v1')
-    labels = set()
+# Returns this thread's Vision API client, building it on first use so the
+# discovery document is only fetched once per thread.
+def get_vision_service():
+    service = getattr(_vision, 'service', None)
+    if service is None:
+        service = googleapiclient.discovery.build(
+            'vision', 'v1', cache_discovery=False)
+        _vision.service = service
+    return service
 
-    # Label photo with its name, sans extension.
-    index = photo_name.index('.jpg')
-    photo_name_label = photo_name[:index]
-    labels.add(photo_name_label)
+
+# Use Cloud Vision API to get labels for a photo. The photo is also labelled
+# with name_label, its name sans extension.
+def get_labels(uri, name_label):
+    service = get_vision_service()
+    labels = set([name_label])
 
     service_request = service.images().annotate(body={
         'requests': [{
@@ -330,8 +524,6 @@ def get_labels(uri, photo_name):
     response = service_request.execute()
     labels_full = response['responses'][0].get('labelAnnotations')
 
-    ignore = set(['of', 'like', 'the', 'and', 'a', 'an', 'with'])
-
     # Add labels to the labels list if they are not already in the list and are
     # not in the ignore list.
     if labels_full is not None:
@@ -342,7 +534,8 @@ def get_labels(uri, photo_name):
                 # labels list if not already.
                 descriptors = label['description'].split()
                 for descript in descriptors:
-                    if descript not in labels and descript not in ignore:
+                    if (descript not in labels and
+                            descript not in IGNORED_LABEL_WORDS):
                         labels.add(descript)
 
     return labels